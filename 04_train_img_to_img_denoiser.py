@@ -2,17 +2,33 @@
 OSEM PET images to high quality (ground truth) PET images."""
 
 import argparse
+import contextlib
+import hashlib
+import os
+import multiprocessing
 import matplotlib.pyplot as plt
 
 import json
 import torch
-from torch.utils.data import DataLoader
+import torch.distributed as dist
+import torch.nn.functional as F
+from torch.nn.parallel import DistributedDataParallel
+from torch.utils.data import DataLoader, DistributedSampler
 from pathlib import Path
 from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from torchmetrics.image import PeakSignalNoiseRatio
 
-from data_utils import BrainwebLMPETDataset
-from utils import plot_batch_input_output_target
+from data_utils import (
+    BrainwebLMPETDataset,
+    CachedImageDataset,
+    DeviceBatchLoader,
+    atomic_write,
+    cache_image_dataset,
+    get_data_dirs,
+    stack_image_dataset,
+)
+from utils import plot_batch_input_output_target, to_np
 from models import DENOISER_MODEL_REGISTRY
 
 
@@ -28,6 +44,39 @@ def parse_json_model_kwargs(arg: str):
     return obj
 
 
+def positive_int(arg: str):
+    value = int(arg)
+    if value < 1:
+        raise argparse.ArgumentTypeError(f"must be a positive integer, got {value}")
+    return value
+
+
+def state_to_cpu(obj):
+    """recursively copy all tensors of a (nested) state dict to the CPU"""
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().to("cpu", copy=True)
+    if isinstance(obj, dict):
+        return {k: state_to_cpu(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(state_to_cpu(v) for v in obj)
+    return obj
+
+
+def save_checkpoint(
+    checkpoint: dict, paths: list[Path], best_model_path: Path | None = None
+):
+    """save a checkpoint to all paths and (optionally) point the best model
+    symlink to the last path once it was written completely"""
+    for path in paths:
+        atomic_write(path, lambda tmp_path: torch.save(checkpoint, tmp_path))
+
+    if best_model_path is not None:
+        atomic_write(
+            best_model_path, lambda tmp_link: tmp_link.symlink_to(paths[-1].name)
+        )
+        print(f"Best model symlinked to {best_model_path} -> {paths[-1].name}")
+
+
 # input parameters
 parser = argparse.ArgumentParser(description="Train image to image denoiser model")
 
@@ -55,6 +104,13 @@ parser.add_argument(
     help="Number of training samples",
 )
 parser.add_argument("--tr_batch_size", type=int, default=5, help="Training batch size")
+parser.add_argument(
+    "--grad_accum_steps",
+    type=positive_int,
+    default=1,
+    help="Number of batches over which gradients are accumulated before each "
+    "optimizer step (effective batch size = tr_batch_size * grad_accum_steps)",
+)
 parser.add_argument(
     "--num_validation_samples",
     type=int,
@@ -68,11 +124,81 @@ parser.add_argument("--seed", type=int, default=42, help="Random seed")
 parser.add_argument(
     "--print_gradient_norms",
     action="store_true",
-    help="Print gradient norms during training (useful for debugging)",
+    help="Print the total gradient norm during training (useful for debugging)",
+)
+parser.add_argument(
+    "--verbose_gradient_norms",
+    action="store_true",
+    help="Print the gradient norms of all parameters once per epoch "
+    "(requires --print_gradient_norms)",
 )
 parser.add_argument(
     "--count_level", type=float, default=1.0, help="count level of input data"
 )
+parser.add_argument(
+    "--num_workers",
+    type=int,
+    default=min(os.cpu_count() or 1, 4),
+    help="Number of data loader worker processes (0 loads data in the main process)",
+)
+parser.add_argument(
+    "--compile",
+    action="store_true",
+    help="Compile the model with torch.compile (fuses kernels, slow first epoch)",
+)
+parser.add_argument(
+    "--amp",
+    choices=["none", "bf16", "fp16"],
+    default="none",
+    help="Mixed precision for the forward passes (fp16 uses a gradient scaler)",
+)
+parser.add_argument(
+    "--plot_every",
+    type=int,
+    default=10,
+    help="Plot validation samples every N epochs (and after the last epoch), "
+    "0 only plots after the last epoch",
+)
+parser.add_argument(
+    "--plot_metrics_every",
+    type=int,
+    default=5,
+    help="Plot the loss and PSNR curves every N epochs (and after the last epoch), "
+    "0 only plots after the last epoch",
+)
+parser.add_argument(
+    "--save_every",
+    type=int,
+    default=0,
+    help="Keep an epoch checkpoint every N epochs, 0 only keeps the best epochs "
+    "(last.pth is always overwritten after every epoch)",
+)
+parser.add_argument(
+    "--save_optimizer_state",
+    action="store_true",
+    help="Save the optimizer state in every checkpoint such that training can be "
+    "resumed (by default it is only saved after the last epoch)",
+)
+parser.add_argument(
+    "--distributed",
+    action="store_true",
+    help="Use DistributedDataParallel on multiple GPUs "
+    "(launch with torchrun --nproc_per_node=NUM_GPUS)",
+)
+parser.add_argument(
+    "--cache_dir",
+    type=str,
+    default=None,
+    help="Directory where the input and target images are cached in a single "
+    "memory mapped file per data set (e.g. on a local fast disk). "
+    "Delete the cache if the underlying data is regenerated.",
+)
+parser.add_argument(
+    "--cache_on_gpu",
+    action="store_true",
+    help="Keep all training and validation images on the GPU (if they fit) "
+    "and slice the batches directly from there instead of using a DataLoader",
+)
 
 args = parser.parse_args()
 
@@ -85,21 +211,68 @@ num_epochs = args.num_epochs
 lr = args.lr
 num_training_samples = args.num_training_samples
 tr_batch_size = args.tr_batch_size
+grad_accum_steps: int = args.grad_accum_steps
 num_validation_samples = args.num_validation_samples
 val_batch_size = args.val_batch_size
 print_gradient_norms: bool = args.print_gradient_norms
+verbose_gradient_norms: bool = args.verbose_gradient_norms
+num_workers: int = args.num_workers
+compile_model: bool = args.compile
+amp: str = args.amp
+plot_every: int = args.plot_every
+plot_metrics_every: int = args.plot_metrics_every
+save_every: int = args.save_every
+save_optimizer_state: bool = args.save_optimizer_state
+distributed: bool = args.distributed
+cache_dir: Path | None = Path(args.cache_dir) if args.cache_dir is not None else None
+cache_on_gpu: bool = args.cache_on_gpu
+
+if distributed and not ("RANK" in os.environ and "LOCAL_RANK" in os.environ):
+    parser.error("--distributed requires launching the script with torchrun")
+
+# the validation sample plots are rendered in a separate process of the main
+# process (rank 0 under torchrun)
+# we explicitly fork, since spawning would re-execute this script, and we start
+# the worker right away, before any CUDA context, data loader or thread exists
+# on platforms without fork, the plots are created synchronously
+plot_executor = None
+if (not distributed or int(os.environ["RANK"]) == 0) and (
+    "fork" in multiprocessing.get_all_start_methods()
+):
+    plot_executor = ProcessPoolExecutor(
+        max_workers=1, mp_context=multiprocessing.get_context("fork")
+    )
+    plot_executor.submit(int).result()
+
+# setup of distributed data parallel training
+# every process (rank) trains on its own shard of the training data and only
+# the main process writes logs, plots and checkpoints
+if distributed:
+    dist.init_process_group("nccl")
+    rank = dist.get_rank()
+    world_size = dist.get_world_size()
+    local_rank = int(os.environ["LOCAL_RANK"])
+    torch.cuda.set_device(local_rank)
+    device = torch.device(f"cuda:{local_rank}")
+else:
+    rank = 0
+    world_size = 1
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+is_main = rank == 0
 
 # create a directory for the model checkpoints
 run_id = datetime.now().strftime("%Y%m%d_%H%M%S")
 model_dir = Path(f"checkpoints_denoiser/{model_class}_run_{run_id}")
-model_dir.mkdir(parents=True, exist_ok=True)
 
-# auto convert the Namespace args to a dictionary
-args_dict = vars(args)
-# save the arguments to a json file
-with open(model_dir / "args.json", "w", encoding="UTF8") as f:
-    json.dump(args_dict, f, indent=4)
-print(f"Arguments saved to {model_dir / 'args.json'}")
+if is_main:
+    model_dir.mkdir(parents=True, exist_ok=True)
+
+    # auto convert the Namespace args to a dictionary
+    args_dict = vars(args)
+    # save the arguments to a json file
+    with open(model_dir / "args.json", "w", encoding="UTF8") as f:
+        json.dump(args_dict, f, indent=4)
+    print(f"Arguments saved to {model_dir / 'args.json'}")
 
 # %%
 # setup of data loaders
@@ -107,25 +280,104 @@ print(f"Arguments saved to {model_dir / 'args.json'}")
 
 torch.manual_seed(seed)
 
-all_data_dirs = sorted(
-    list(Path("data/sim_pet_data").glob(f"subject*_countlevel_{count_level:.1f}_*"))
+# keep the worker processes alive across epochs and let each of them prefetch
+# a few batches such that data loading overlaps with training
+loader_kwargs = dict(
+    num_workers=num_workers,
+    pin_memory=torch.cuda.is_available(),
 )
+if num_workers > 0:
+    loader_kwargs["persistent_workers"] = True
+    loader_kwargs["prefetch_factor"] = 2
+
+
+def cached_dataset(dataset: BrainwebLMPETDataset) -> CachedImageDataset:
+    """replace an image only dataset by its memory mapped cache, the cache file
+    is created by the main process if it does not exist yet"""
+    # the cache file name only depends on the (sorted) data directories, their
+    # (shuffled) order is applied when reading from the cache
+    dirs_hash = hashlib.sha1(
+        "\n".join(sorted(str(d.resolve()) for d in dataset.data_dirs)).encode()
+    ).hexdigest()[:16]
+    cache_file = cache_dir / f"images_{dirs_hash}.pt"
+
+    if is_main and not cache_file.exists():
+        print(f"Caching {len(dataset)} samples in {cache_file}")
+        cache_image_dataset(dataset, cache_file)
+    if distributed:
+        dist.barrier()
+
+    return CachedImageDataset(cache_file, dataset.data_dirs)
+
+
+def device_batch_loader(dataset, **kwargs) -> DeviceBatchLoader | None:
+    """move all images of an image only dataset to the GPU and return a loader
+    that slices the batches from there, returns None if the images do not fit"""
+    # estimate the (float32) size of all images from the first sample
+    sample = dataset[0]
+    num_bytes = len(dataset) * 4 * (sample["input"].numel() + sample["target"].numel())
+
+    # leave at least half of the free GPU memory for the training itself
+    free_memory, _ = torch.cuda.mem_get_info(device)
+    fits = torch.tensor(int(num_bytes <= 0.5 * free_memory), device=device)
+    # all ranks have to take the same decision to get the same number of batches
+    if distributed:
+        dist.all_reduce(fits, op=dist.ReduceOp.MIN)
+
+    if not fits.item():
+        if is_main:
+            print(
+                f"{len(dataset)} samples do not fit on the GPU, using a DataLoader instead"
+            )
+        return None
+
+    inputs, targets = stack_image_dataset(dataset)
+
+    return DeviceBatchLoader(
+        inputs.to(device, memory_format=torch.channels_last_3d),
+        targets.to(device),
+        **kwargs,
+    )
+
+
+all_data_dirs = get_data_dirs(Path("data/sim_pet_data"), count_level)
 
 # setup the training data loader
 train_dirs = all_data_dirs[:num_training_samples]
 
 # write the training directories to a json file
-with open(model_dir / "train_dirs.json", "w", encoding="UTF8") as f:
-    json.dump([str(d) for d in train_dirs], f, indent=4)
+if is_main:
+    with open(model_dir / "train_dirs.json", "w", encoding="UTF8") as f:
+        json.dump([str(d) for d in train_dirs], f, indent=4)
 
 # make sure that skip_raw_data is set to True
 # in this case the loader only returns the OSEM input image and the ground truth which is faster
 train_dataset = BrainwebLMPETDataset(train_dirs, shuffle=True, skip_raw_data=True)
-train_loader = DataLoader(
-    train_dataset,
-    batch_size=tr_batch_size,
-    drop_last=True,
+if cache_dir is not None:
+    train_dataset = cached_dataset(train_dataset)
+# in the distributed case, the sampler splits the (reshuffled) training data
+# across the ranks every epoch
+train_sampler = (
+    DistributedSampler(train_dataset, shuffle=True, seed=seed) if distributed else None
 )
+train_loader = None
+if cache_on_gpu and device.type == "cuda":
+    # the device batch loader uses the same sampler (if any) as the DataLoader
+    # such that the training order does not depend on where the data is stored
+    train_loader = device_batch_loader(
+        train_dataset,
+        batch_size=tr_batch_size,
+        sampler=train_sampler,
+        drop_last=True,
+    )
+if train_loader is None:
+    train_loader = DataLoader(
+        train_dataset,
+        batch_size=tr_batch_size,
+        sampler=train_sampler,
+        drop_last=True,
+        **loader_kwargs,
+    )
 
 # setup the validation data loader
 val_dirs = all_data_dirs[
@@ -133,151 +385,329 @@ val_dirs = all_data_dirs[
 ]
 
 # write the validation directories to a json file
-with open(model_dir / "val_dirs.json", "w", encoding="UTF8") as f:
-    json.dump([str(d) for d in val_dirs], f, indent=4)
+if is_main:
+    with open(model_dir / "val_dirs.json", "w", encoding="UTF8") as f:
+        json.dump([str(d) for d in val_dirs], f, indent=4)
 
 # make sure that skip_raw_data is set to True
 # in this case the loader only returns the OSEM input image and the ground truth which is faster
 val_dataset = BrainwebLMPETDataset(val_dirs, shuffle=False, skip_raw_data=True)
-val_loader = DataLoader(
-    val_dataset,
-    batch_size=val_batch_size,
-)
+if cache_dir is not None:
+    val_dataset = cached_dataset(val_dataset)
+val_loader = None
+if cache_on_gpu and device.type == "cuda":
+    # all ranks evaluate the complete validation set
+    val_loader = device_batch_loader(val_dataset, batch_size=val_batch_size)
+if val_loader is None:
+    val_loader = DataLoader(
+        val_dataset,
+        batch_size=val_batch_size,
+        **loader_kwargs,
+    )
 
 # %%
 # setup of (unet) image to image denoiser model
 ################################################################################
 
-# model setup
-device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+# the input shapes are fixed during training, so let cuDNN benchmark and cache
+# the fastest 3D convolution algorithms and allow TF32 on Ampere+ GPUs
+# note: the seed still controls the initialization and the data order, but the
+# training is not bitwise reproducible anymore
+torch.backends.cudnn.benchmark = True
+torch.backends.cudnn.allow_tf32 = True
+torch.set_float32_matmul_precision("high")
 
 # setup UNET model
 # in principle we can have any NN here
 # if we want to use in in combination with data fidelity gradient layers,
 # we should make sure that the output is non-negative
-model = DENOISER_MODEL_REGISTRY[model_class](**model_kwargs).to(device)
+# the model and the input volumes use the channels last (NDHWC) memory format
+# for which the fastest cuDNN 3D convolution kernels exist
+model = DENOISER_MODEL_REGISTRY[model_class](**model_kwargs).to(
+    device, memory_format=torch.channels_last_3d
+)
 
-# setup the optimizer and loss function
-optimizer = torch.optim.Adam(model.parameters(), lr=lr)
-criterion = torch.nn.MSELoss()
+# net is used for all forward passes, while the state dict is always taken from
+# the unwrapped model such that the checkpoints can be loaded without DDP or torch.compile
+net = model
+if distributed:
+    ddp_net = DistributedDataParallel(model, device_ids=[local_rank])
+    net = ddp_net
+if compile_model:
+    # torch.compile is lazy, so we run a warm-up forward pass with a batch of the
+    # training shape such that a missing backend (e.g. Triton or a C++ compiler)
+    # fails here and not in the training loop
+    try:
+        net = torch.compile(net)
+        warmup_sample = train_dataset[0]["input"]
+        warmup_x = (
+            warmup_sample.unsqueeze(0)
+            .repeat(tr_batch_size, *[1] * warmup_sample.ndim)
+            .to(device, memory_format=torch.channels_last_3d)
+        )
+        model.eval()
+        with torch.no_grad():
+            net(warmup_x)
+        del warmup_sample, warmup_x
+    except Exception as e:
+        if is_main:
+            print(f"torch.compile not available ({e}), using eager model")
+        net = ddp_net if distributed else model
+
+# setup the optimizer (the MSE loss is computed with F.mse_loss)
+# the fused Adam implementation updates all parameters in a single kernel,
+# fall back to the multi-tensor (foreach) implementation if it is not supported
+try:
+    optimizer = torch.optim.Adam(model.parameters(), lr=lr, fused=True)
+except (RuntimeError, TypeError):
+    optimizer = torch.optim.Adam(model.parameters(), lr=lr, foreach=True)
 
 psnr = PeakSignalNoiseRatio(data_range=(0, 4)).to(device)
 
-# save model architecture
-val_psnr = torch.zeros(num_epochs)
-val_loss_avg = torch.zeros(num_epochs)
-train_loss_avg = torch.zeros(num_epochs)
+# setup of mixed precision training
+# bf16 has the same range as fp32 and does not need loss scaling
+# fp16 needs a gradient scaler to avoid underflow of small gradients
+amp_dtype = {"bf16": torch.bfloat16, "fp16": torch.float16}.get(amp)
+scaler = torch.amp.GradScaler(device.type, enabled=amp == "fp16")
+
+
+def autocast():
+    return torch.autocast(
+        device_type=device.type, dtype=amp_dtype, enabled=amp_dtype is not None
+    )
+
+
+# per epoch metrics are stored as python floats on the host
+val_psnr: list[float] = []
+val_loss_avg: list[float] = []
+train_loss_avg: list[float] = []
 
 # %%
 # training + validation loop
 ################################################################################
 
+plot_futures = []
+
+# checkpoints are written to disk in a background thread
+save_executor = ThreadPoolExecutor(max_workers=1)
+save_future = None
+
+# the figure for the training metrics is created once and reused
+if is_main:
+    fig, ax = plt.subplots(3, 2, layout="constrained", figsize=(12, 6), sharex="col")
+
 # training loop
-model.train()
 for epoch in range(1, num_epochs + 1):
-    batch_losses = torch.zeros(len(train_loader))
+    # switch back to training mode, since the validation at the end of every
+    # epoch switches the model to evaluation mode
+    model.train()
+    if train_sampler is not None:
+        train_sampler.set_epoch(epoch)
+
+    # losses and metrics are accumulated on the device and only transferred to
+    # the host once per epoch to avoid a device synchronization after every batch
+    batch_losses = torch.zeros(len(train_loader), device=device)
     for batch_idx, batch in enumerate(train_loader):
-        x = batch["input"].to(device)
-        target = batch["target"].to(device)
+        x = batch["input"].to(
+            device, non_blocking=True, memory_format=torch.channels_last_3d
+        )
+        target = batch["target"].to(device, non_blocking=True)
+
+        # gradients are accumulated over grad_accum_steps batches (fewer for the
+        # last group of an epoch) before the optimizer step
+        group_start = (batch_idx // grad_accum_steps) * grad_accum_steps
+        group_size = min(grad_accum_steps, len(train_loader) - group_start)
+        optimizer_step = batch_idx == group_start + group_size - 1
+
+        # in the distributed case, the gradients are only synchronized across the
+        # ranks in the backward pass preceding the optimizer step
+        if distributed and not optimizer_step:
+            sync_context = ddp_net.no_sync()
+        else:
+            sync_context = contextlib.nullcontext()
+
+        with sync_context:
+            with autocast():
+                output = net(x)
+                loss = F.mse_loss(output, target, reduction="mean")
+            scaler.scale(loss / group_size).backward()
+
+        batch_losses[batch_idx] = loss.detach()
+
+        if is_main:
+            print(
+                f"Epoch [{epoch:04}/{num_epochs:04}] Batch [{(batch_idx+1):03}/{len(train_loader):03}]",
+                end="\r",
+            )
 
-        optimizer.zero_grad()
-        output = model(x)
-        loss = criterion(output, target)
-        loss.backward()
+        if not optimizer_step:
+            continue
 
         # print gradient norms if requested - useful to see if gradients are exploding or vanishing
-        if print_gradient_norms:
-            # print gradient norms
-            for name, param in model.named_parameters():
-                if param.grad is None:
-                    print(f"{name:40s} | grad is None")
-                else:
-                    print(f"{name:40s} | grad norm: {param.grad.norm():.6f}")
+        # the gradients are synchronized across the ranks, so only the main process prints them
+        if print_gradient_norms and is_main:
+            # undo the loss scaling such that the true gradient norms are printed
+            scaler.unscale_(optimizer)
+            # the total norm of all gradients is computed with a single fused
+            # reduction (max_norm=inf means that no clipping is applied)
+            total_norm = torch.nn.utils.clip_grad_norm_(
+                model.parameters(), max_norm=float("inf")
+            )
+            print(f"\n{'total':40s} | grad norm: {total_norm:.6f}")
+
+            # print the gradient norms of all parameters for the first step of every epoch
+            if verbose_gradient_norms and group_start == 0:
+                grads = {
+                    n: p.grad for n, p in model.named_parameters() if p.grad is not None
+                }
+                # transfer all norms to the host at once
+                grad_norms = dict(
+                    zip(grads, torch.stack([g.norm() for g in grads.values()]).tolist())
+                )
+                for name, _ in model.named_parameters():
+                    if name not in grad_norms:
+                        print(f"{name:40s} | grad is None")
+                    else:
+                        print(f"{name:40s} | grad norm: {grad_norms[name]:.6f}")
             print()
 
-        optimizer.step()
-        batch_losses[batch_idx] = loss.item()
+        scaler.step(optimizer)
+        scaler.update()
+        optimizer.zero_grad(set_to_none=True)
 
-        print(
-            f"Epoch [{epoch:04}/{num_epochs:04}] Batch [{(batch_idx+1):03}/{len(train_loader):03}] - tr. loss: {loss.item():.2E}",
-            end="\r",
-        )
+    if distributed:
+        # gather the batch losses of all ranks
+        all_batch_losses = [torch.zeros_like(batch_losses) for _ in range(world_size)]
+        dist.all_gather(all_batch_losses, batch_losses)
+        batch_losses = torch.cat(all_batch_losses)
 
     loss_avg = batch_losses.mean().item()
-    train_loss_avg[epoch - 1] = loss_avg
+    train_loss_avg.append(loss_avg)
     loss_std = batch_losses.std().item()
-    print(
-        f"\nEpoch [{epoch:04}/{num_epochs:04}] tr.  loss: {loss_avg:.2E} +- {loss_std:.2E}"
+    if is_main:
+        print(
+            f"\nEpoch [{epoch:04}/{num_epochs:04}] tr.  loss: {loss_avg:.2E} +- {loss_std:.2E}"
+        )
+
+    plot_epoch = is_main and (
+        (plot_every > 0 and epoch % plot_every == 0) or epoch == num_epochs
     )
 
+    if plot_epoch:
+        # wait for the plots of the previous plot epoch and raise possible errors
+        for future in plot_futures:
+            future.result()
+        plot_futures = []
+
     # validation loop
+    # all ranks evaluate the complete validation set (with identical weights)
+    # such that they all take the same decisions based on the validation metrics
     model.eval()
-    with torch.no_grad():
-        val_losses = torch.zeros(len(val_loader))
-        batch_psnr = torch.zeros(len(val_loader))
+    with torch.inference_mode():
+        val_losses = torch.zeros(len(val_loader), device=device)
+        batch_psnr = torch.zeros(len(val_loader), device=device)
         for batch_idx, batch in enumerate(val_loader):
-            val_x = batch["input"].to(device)
-            val_target = batch["target"].to(device)
-
-            val_output = model(val_x)
-            val_loss = criterion(val_output, val_target)
-            val_losses[batch_idx] = val_loss.item()
+            val_x = batch["input"].to(
+                device, non_blocking=True, memory_format=torch.channels_last_3d
+            )
+            val_target = batch["target"].to(device, non_blocking=True)
+
+            with autocast():
+                val_output = net(val_x)
+            # metrics and plots are computed in full precision
+            val_output = val_output.float()
+            val_loss = F.mse_loss(val_output, val_target, reduction="mean")
+            val_losses[batch_idx] = val_loss
             batch_psnr[batch_idx] = psnr(val_output, val_target)
 
             # plot input, output, and target for the current validation batch
-            plot_batch_input_output_target(
-                val_x,
-                val_output,
-                val_target,
-                model_dir,
-                prefix=f"val_sample_batch_{batch_idx:03}",
+            if plot_epoch:
+                plot_args = (to_np(val_x), to_np(val_output), to_np(val_target))
+                plot_prefix = f"val_sample_batch_{batch_idx:03}"
+                if plot_executor is not None:
+                    plot_futures.append(
+                        plot_executor.submit(
+                            plot_batch_input_output_target,
+                            *plot_args,
+                            model_dir,
+                            prefix=plot_prefix,
+                        )
+                    )
+                else:
+                    plot_batch_input_output_target(
+                        *plot_args, model_dir, prefix=plot_prefix
+                    )
+
+        val_loss_avg.append(val_losses.mean().item())
+        val_psnr.append(batch_psnr.mean().item())
+
+        if is_main:
+            print(
+                f"Epoch [{epoch:04}/{num_epochs:04}] val. loss: {val_loss_avg[-1]:.2E}"
+            )
+            print(
+                f"Epoch [{epoch:04}/{num_epochs:04}] val. PSNR: {val_psnr[-1]:.2E}"
             )
 
-        val_loss_avg[epoch - 1] = val_losses.mean().item()
-        val_psnr[epoch - 1] = batch_psnr.mean().item()
+    # only the main process writes checkpoints and plots
+    if not is_main:
+        continue
 
-        print(
-            f"Epoch [{epoch:04}/{num_epochs:04}] val. loss: {val_loss_avg[epoch - 1]:.2E}"
-        )
-        print(
-            f"Epoch [{epoch:04}/{num_epochs:04}] val. PSNR: {val_psnr[epoch - 1]:.2E}"
-        )
+    is_best = epoch == 1 or val_psnr[-1] > max(val_psnr[:-1])
+    epoch_model_path = model_dir / f"epoch_{epoch:04}.pth"
 
     # save model checkpoint
-    torch.save(
-        {
-            "model_class": model_class,
-            "model_kwargs": model_kwargs,
-            "model_state_dict": model.state_dict(),
-            "optimizer_state_dict": optimizer.state_dict(),
-            "epoch": epoch,
-            "val_pnsr": val_psnr[epoch - 1],
-            "val_loss": val_loss_avg,
-        },
-        model_dir / f"epoch_{epoch:04}.pth",
+    # last.pth is overwritten every epoch, epoch checkpoints are only kept for
+    # new best models and every save_every epochs
+    save_paths = [model_dir / "last.pth"]
+    if is_best or (save_every > 0 and epoch % save_every == 0):
+        save_paths.append(epoch_model_path)
+
+    checkpoint = {
+        "model_class": model_class,
+        "model_kwargs": model_kwargs,
+        "model_state_dict": model.state_dict(),
+        "epoch": epoch,
+        "val_pnsr": val_psnr[-1],
+        "val_loss": val_loss_avg,
+    }
+    # the optimizer state (twice the model size for Adam) is only needed to
+    # resume training
+    if save_optimizer_state or epoch == num_epochs:
+        checkpoint["optimizer_state_dict"] = optimizer.state_dict()
+
+    # copy the state to the CPU such that training can continue while the
+    # checkpoint is written, but never write two checkpoints at the same time
+    # waiting for the previous checkpoint also raises a failed save here
+    if save_future is not None:
+        save_future.result()
+    # if the current val_psnr is the best so far, best.pth is symlinked to the
+    # epoch checkpoint after it was written
+    save_future = save_executor.submit(
+        save_checkpoint,
+        state_to_cpu(checkpoint),
+        save_paths,
+        model_dir / "best.pth" if is_best else None,
     )
 
-    # if the current val_psnr is the best so far, save the model
-    if epoch == 1 or val_psnr[epoch - 1] > val_psnr[: epoch - 1].max():
-        best_model_path = model_dir / "best.pth"
-        epoch_model_path = model_dir / f"epoch_{epoch:04}.pth"
-        # Remove existing symlink if it exists
-        if best_model_path.exists() or best_model_path.is_symlink():
-            best_model_path.unlink()
-        # Create a symlink pointing to the current epoch checkpoint
-        best_model_path.symlink_to(epoch_model_path.name)
-        print(f"Best model symlinked to {best_model_path} -> {epoch_model_path.name}")
+    if not (
+        (plot_metrics_every > 0 and epoch % plot_metrics_every == 0)
+        or epoch == num_epochs
+    ):
+        continue
 
     # plot and save training and validation loss and val. PSNR
-    fig, ax = plt.subplots(3, 2, layout="constrained", figsize=(12, 6), sharex="col")
+    for axx in ax.ravel():
+        axx.cla()
+
     epochs = range(1, epoch + 1)
-    ax[0, 0].semilogy(epochs, train_loss_avg[:epoch].cpu().numpy())
-    ax[1, 0].semilogy(epochs, val_loss_avg[:epoch].cpu().numpy())
-    ax[2, 0].plot(epochs, val_psnr[:epoch].cpu().numpy())
+    ax[0, 0].semilogy(epochs, train_loss_avg)
+    ax[1, 0].semilogy(epochs, val_loss_avg)
+    ax[2, 0].plot(epochs, val_psnr)
 
-    ax[0, 1].loglog(epochs, train_loss_avg[:epoch].cpu().numpy())
-    ax[1, 1].loglog(epochs, val_loss_avg[:epoch].cpu().numpy())
-    ax[2, 1].semilogx(epochs, val_psnr[:epoch].cpu().numpy())
+    ax[0, 1].loglog(epochs, train_loss_avg)
+    ax[1, 1].loglog(epochs, val_loss_avg)
+    ax[2, 1].semilogx(epochs, val_psnr)
 
     ax[0, 0].set_ylabel("training loss")
     ax[1, 0].set_ylabel("validation loss")
@@ -288,5 +718,24 @@ for epoch in range(1, num_epochs + 1):
 
     for axx in ax.ravel():
         axx.grid(ls=":")
-    fig.savefig(model_dir / "current_metrics.pdf")
+
+    # intermediate results are saved as (cheap) png, the final result as pdf
+    if epoch == num_epochs:
+        fig.savefig(model_dir / "current_metrics.pdf")
+    else:
+        fig.savefig(model_dir / "current_metrics.png")
+
+if save_future is not None:
+    save_future.result()
+save_executor.shutdown()
+
+for future in plot_futures:
+    future.result()
+if plot_executor is not None:
+    plot_executor.shutdown()
+
+if is_main:
     plt.close(fig)
+
+if distributed:
+    dist.destroy_process_group()
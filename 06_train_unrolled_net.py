@@ -8,7 +8,7 @@ from pathlib import Path
 from datetime import datetime
 from torchmetrics.image import PeakSignalNoiseRatio
 
-from data_utils import BrainwebLMPETDataset, brainweb_collate_fn
+from data_utils import BrainwebLMPETDataset, brainweb_collate_fn, get_data_dirs
 from utils import plot_batch_input_output_target
 from models import DENOISER_MODEL_REGISTRY, LMNet
 
@@ -124,9 +124,7 @@ print(f"Arguments saved to {model_dir / 'args.json'}")
 
 torch.manual_seed(seed)
 
-all_data_dirs = sorted(
-    list(Path("data/sim_pet_data").glob(f"subject*_countlevel_{count_level:.1f}_*"))
-)
+all_data_dirs = get_data_dirs(Path("data/sim_pet_data"), count_level)
 
 # setup the training data loader
 train_dirs = all_data_dirs[:num_training_samples]
@@ -1,3 +1,5 @@
+import contextlib
+import os
 import json
 import torch
 import parallelproj
@@ -11,7 +13,10 @@ def load_lm_pet_data(odir: Path, skip_raw_data: bool = False):
     """
 
     if skip_raw_data:
-        return torch.load(odir / "ground_truth.pt")
+        # image only data is always loaded to the CPU, since the simulation
+        # saves the tensors on the GPU (if available) and CUDA tensors can
+        # neither be pinned nor be loaded in data loader worker processes
+        return torch.load(odir / "ground_truth.pt", map_location="cpu")
     else:
         data_tensors = torch.load(odir / "data_tensors.pt")
         ground_truth = torch.load(odir / "ground_truth.pt")
@@ -62,6 +67,68 @@ def load_lm_pet_data(odir: Path, skip_raw_data: bool = False):
         return lm_pet_lin_op, contamination_list, adjoint_ones, x_true
 
 
+def atomic_write(path: Path, write_fn):
+    """
+    Calls write_fn with a temporary path next to path and replaces path with it
+    afterwards, such that an interrupted run never leaves an incomplete file
+    behind and concurrent processes never read or write the same partial file.
+    """
+    tmp_path = path.with_suffix(f".{os.getpid()}.tmp")
+    tmp_path.unlink(missing_ok=True)
+    write_fn(tmp_path)
+    tmp_path.replace(path)
+
+
+def get_data_dirs(data_root: Path, count_level: float) -> list[Path]:
+    """
+    Returns the sorted simulated data directories for a given count level.
+    The results of the directory scans are stored in a single index file
+    (one entry per count level) that is reused as long as no directories were
+    added to / removed from data_root.
+    """
+
+    # the index file lives in its own subdirectory, since writing it directly
+    # into data_root would change the modification time of data_root itself
+    index_dir = data_root / ".data_dirs_index"
+    index_file = index_dir / "data_dirs.json"
+    key = f"{count_level:.1f}"
+
+    # if data_root is not writable (e.g. shared storage), we just use the scan
+    # and report the failure when the index is written
+    with contextlib.suppress(OSError):
+        index_dir.mkdir(exist_ok=True)
+
+    # adding or removing a directory updates the modification time of data_root
+    # so all entries of the index are valid as long as its stored time stamp
+    # matches exactly
+    # the time stamp is taken before the scan such that directories added
+    # during the scan invalidate the index
+    data_root_mtime_ns = data_root.stat().st_mtime_ns
+    index = {}
+    if index_file.exists():
+        with open(index_file, "r", encoding="UTF8") as f:
+            index = json.load(f)
+        if index.get("data_root_mtime_ns") != data_root_mtime_ns:
+            index = {}
+        elif key in index["data_dirs"]:
+            return [Path(d) for d in index["data_dirs"][key]]
+
+    data_dirs = sorted(data_root.glob(f"subject*_countlevel_{key}_*"))
+    index.setdefault("data_dirs", {})[key] = [str(d) for d in data_dirs]
+    index["data_root_mtime_ns"] = data_root_mtime_ns
+
+    def write_index(tmp_file: Path):
+        with open(tmp_file, "w", encoding="UTF8") as f:
+            json.dump(index, f, indent=4)
+
+    try:
+        atomic_write(index_file, write_index)
+    except OSError as e:
+        print(f"Could not write data directory index {index_file} ({e})")
+
+    return data_dirs
+
+
 class BrainwebLMPETDataset(torch.utils.data.Dataset):
     """
     PyTorch Dataset for supervised PET learning.
@@ -92,9 +159,11 @@ class BrainwebLMPETDataset(torch.utils.data.Dataset):
 
     def __getitem__(self, idx):
         odir = self._data_dirs[idx]
-        input_img = torch.load(odir / "mlem_reconstructions.pt")[
-            "x_mlem_early_filtered"
-        ]
+        # image only data is loaded to the CPU (see load_lm_pet_data)
+        input_img = torch.load(
+            odir / "mlem_reconstructions.pt",
+            map_location="cpu" if self._skip_raw_data else None,
+        )["x_mlem_early_filtered"]
 
         if self._skip_raw_data:
             return {
@@ -114,6 +183,117 @@ class BrainwebLMPETDataset(torch.utils.data.Dataset):
             }
 
 
+class CachedImageDataset(torch.utils.data.Dataset):
+    """
+    PyTorch Dataset for image only (input and target) PET learning.
+    Loads stacked input and target images from a single cache file created by
+    cache_image_dataset(). The file is memory mapped such that the data is read
+    from disk only once and shared between data loader workers.
+    The cache stores the samples in sorted order, if data_dirs is given the
+    samples are returned in the order of data_dirs (e.g. a shuffled order).
+    Each sample returns:
+      - input image
+      - label image
+    """
+
+    def __init__(self, cache_file: Path, data_dirs: list[Path] | None = None):
+        cached_data = torch.load(cache_file, mmap=True)
+        self._input = cached_data["input"]
+        self._target = cached_data["target"]
+
+        if data_dirs is None:
+            self._indices = list(range(self._input.shape[0]))
+        else:
+            cached_idx = {d: i for i, d in enumerate(cached_data["data_dirs"])}
+            self._indices = [cached_idx[str(d.resolve())] for d in data_dirs]
+
+    def __len__(self):
+        return len(self._indices)
+
+    def __getitem__(self, idx):
+        i = self._indices[idx]
+        return {"input": self._input[i], "target": self._target[i]}
+
+
+def stack_image_dataset(dataset: torch.utils.data.Dataset):
+    """
+    Stacks the input and target images of all samples of an image only dataset
+    (skip_raw_data=True) into two contiguous float32 tensors.
+    """
+    samples = [dataset[i] for i in range(len(dataset))]
+    inputs = torch.stack([s["input"] for s in samples]).float().contiguous()
+    targets = torch.stack([s["target"] for s in samples]).float().contiguous()
+
+    return inputs, targets
+
+
+def cache_image_dataset(dataset: BrainwebLMPETDataset, cache_file: Path):
+    """
+    Stacks the input and target images of all samples of an image only dataset
+    (skip_raw_data=True) in the sorted order of its data directories and saves
+    them to a single file, such that the cache is independent of the shuffling.
+    """
+    data_dirs = sorted(d.resolve() for d in dataset.data_dirs)
+    inputs, targets = stack_image_dataset(
+        BrainwebLMPETDataset(data_dirs, shuffle=False, skip_raw_data=True)
+    )
+    cached_data = {
+        "input": inputs,
+        "target": targets,
+        "data_dirs": [str(d) for d in data_dirs],
+    }
+
+    cache_file.parent.mkdir(parents=True, exist_ok=True)
+    atomic_write(cache_file, lambda tmp_file: torch.save(cached_data, tmp_file))
+
+
+class DeviceBatchLoader:
+    """
+    Minimal replacement of a DataLoader for image only data where all input and
+    target images are stacked in two tensors that already reside on the device
+    (e.g. the GPU). Batches are sliced directly from these tensors such that no
+    host to device transfers are needed.
+    Each batch is a dict containing:
+      - input images
+      - label images
+    The samples are visited in the same order as by a DataLoader without
+    shuffling, or in the order of the given sampler (e.g. a DistributedSampler).
+    """
+
+    def __init__(
+        self,
+        inputs: torch.Tensor,
+        targets: torch.Tensor,
+        batch_size: int,
+        sampler: torch.utils.data.Sampler | None = None,
+        drop_last: bool = False,
+    ):
+        self._inputs = inputs
+        self._targets = targets
+        self._batch_size = batch_size
+        self._sampler = sampler
+        self._drop_last = drop_last
+
+    def __len__(self):
+        num_samples = (
+            len(self._sampler) if self._sampler is not None else self._inputs.shape[0]
+        )
+        if self._drop_last:
+            return num_samples // self._batch_size
+        else:
+            return -(-num_samples // self._batch_size)
+
+    def __iter__(self):
+        if self._sampler is not None:
+            idx = torch.tensor(list(self._sampler), device=self._inputs.device)
+        else:
+            idx = torch.arange(self._inputs.shape[0], device=self._inputs.device)
+
+        for i in range(len(self)):
+            batch_idx = idx[i * self._batch_size : (i + 1) * self._batch_size]
+            yield {"input": self._inputs[batch_idx], "target": self._targets[batch_idx]}
+
+
 def brainweb_collate_fn(batch):
     # batch is a list of dicts
     return {